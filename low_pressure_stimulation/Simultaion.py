@@ -27,11 +27,15 @@
 
 
 import numpy as np
-import scipy.sparse as sps
 # For plotting 
 from IPython.display import HTML, display
 # Porepy
 import porepy as pp
+# Numba is optional, and only used to speed up the data transfer below
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 # ## Grid generation
@@ -100,27 +104,61 @@ class MatrixDomain(pp.SlightlyCompressibleDataAssigner):
         return 4.6e-10 / pp.PASCAL
 
     def permeability(self):
-        kxx = np.ones(self.grid().num_cells) * pp.NANO * pp.DARCY
-        return pp.SecondOrderTensor(3, kxx / self.viscosity())
+        kxx = np.full(self.grid().num_cells,
+                      pp.NANO * pp.DARCY / self.viscosity())
+        return pp.SecondOrderTensor(3, kxx)
 
     def viscosity(self):
         return .45 * pp.MILLI * pp.PASCAL * pp.SECOND
 
     def porosity(self):
-        return 0.01 * np.ones(self.grid().num_cells)
+        return np.full(self.grid().num_cells, 0.01)
 
     def density(self):
         return 1014 * pp.KILOGRAM / pp.METER**3
 
-    
+
+class FractureState(object):
+    """ Aperture of all 2D fracture grids, stored in contiguous arrays.
+
+    E0 is the initial aperture and aperture_change the aperture change of all
+    fracture cells, where the cells of grid g occupy slices[g]. Grids are
+    registered one by one with add_grid. finalize then builds the arrays, and
+    makes d['aperture_change'] of each grid a view into aperture_change, so
+    that face_2_cell writes directly into the contiguous array.
+    """
+    def __init__(self):
+        self.grids = []
+        self.data = []
+        self.slices = {}
+        self.num_cells = 0
+
+    def add_grid(self, g, d):
+        self.grids.append(g)
+        self.data.append(d)
+        self.slices[g] = slice(self.num_cells, self.num_cells + g.num_cells)
+        self.num_cells += g.num_cells
+
+    def finalize(self):
+        self.E0 = np.hstack([d['flow_data'].E0 for d in self.data])
+        self.aperture_change = np.zeros(self.num_cells)
+        for g, d in zip(self.grids, self.data):
+            d['aperture_change'] = self.aperture_change[self.slices[g]]
+
+
 class FractureDomain(MatrixDomain):
     def __init__(self, g, data):
-        self.E0 = .1 * pp.MILLI * pp.METER * np.ones(g.num_cells)
-        self.Ed = 0. * np.ones(g.num_cells)        
+        self.E0 = np.full(g.num_cells, .1 * pp.MILLI * pp.METER)
+        self.Ed = np.zeros(g.num_cells)
+        # The aperture is raised to the power 3 - dim, written out for each
+        # dimension to avoid the general power function
+        self._aperture_fn = {1: lambda a: a,
+                             2: lambda a: a * a,
+                             3: lambda a: a * a * a}[3 - g.dim]
         MatrixDomain.__init__(self, g, data)
 
     def aperture(self):
-        return (self.E0 + self.Ed)**(3 - self.grid().dim)
+        return self._aperture_fn(self.E0 + self.Ed)
 
     def permeability(self):
         kxx = (self.E0 + self.Ed)**2 / 12
@@ -128,20 +166,24 @@ class FractureDomain(MatrixDomain):
 #        return tensor.SecondOrder(self.g.dim, np.ones(self.g.num_cells))
 
     def porosity(self):
-        return 1 * np.ones(self.grid().num_cells)
+        return np.ones(self.grid().num_cells)
 
 
 class InjectionDomain(FractureDomain):
-    def source(self, t):
-        tol = 1e-4
-        value = np.zeros(self.grid().num_cells)
-
+    def __init__(self, g, data):
+        # The injection cell is the one closest to the injection point. This
+        # is fixed, so find it here rather than on every call to source
         cell_coord = np.atleast_2d(np.array([1200, 2200, 2000])).T
-        distance = np.sqrt(np.sum(np.abs(self.grid().cell_centers - cell_coord)**2, axis=0))
-        cell = np.argmin(distance)
+        d = g.cell_centers - cell_coord
+        # Squared distance is enough for the argmin
+        self._inj_cell = int(np.argmin(np.einsum('ij,ij->j', d, d)))
+        self._inj_value = 10.0 * pp.KILOGRAM / pp.SECOND / self.density()
+        FractureDomain.__init__(self, g, data)
 
+    def source(self, t):
+        value = np.zeros(self.grid().num_cells)
         if t < 6000 * pp.SECOND + 1e-6:
-            value[cell] = 10.0 * pp.KILOGRAM / pp.SECOND / self.density()
+            value[self._inj_cell] = self._inj_value
         return value
 
 
@@ -199,12 +241,13 @@ def assign_data(gb):
     matrix_rock = pp.Granite()
     matrix_rock.MU = 20 * pp.GIGA * pp.PASCAL
     matrix_rock.LAMBDA = 20 * pp.GIGA * pp.PASCAL
-    
-    # We define the variable aperture_change which will be used to update the aperture
-    # at each time step
-    gb.add_node_props(['aperture_change'])
+    # The apertures of all fractures are stored together
+    state = FractureState()
+
     for g, d in gb:
-        d['aperture_change'] = np.zeros(g.num_cells)
+        # We define the variable aperture_change which will be used to update
+        # the aperture at each time step
+        d['aperture_change'] = np.zeros(g.num_cells, dtype=np.float64)
         if g.dim == 3:
             d['rock'] = matrix_rock
             d['flow_data'] = MatrixDomain(g, d)
@@ -216,6 +259,10 @@ def assign_data(gb):
                 d['flow_data'] = InjectionDomain(g, d)
             else:
                 d['flow_data'] = FractureDomain(g, d)
+            if g.dim == 2:
+                state.add_grid(g, d)
+    state.finalize()
+    return state
 
 
 # ### Transfer data
@@ -225,34 +272,64 @@ def assign_data(gb):
 # In[6]:
 
 
-def cell_2_face(gb, variable):
-    g3 = gb.grids_of_dimension(3)[0]
-    data3 = gb.node_props(g3)
-    face_variable = np.zeros(g3.num_faces)
+def fracture_face_cells(gb, g3):
+    """ Find the mapping between 2D fracture cells and 3D faces.
+
+    The mapping is fixed during the simulation, so we compute it once and pass
+    it to the transfer functions below. Returns a list of (g, d, ci, fi, num_hit)
+    for each 2D grid, where fracture cell ci[i] is connected to 3D face fi[i],
+    and num_hit is the number of faces connected to each fracture cell.
+    Grids without any connection to the 3D grid are left out.
+    """
+    frac_edges = []
     for g, d in gb:
         if g.dim != 2:
             continue
-        f_c = gb.edge_props((g3, g), 'face_cells')
-        ci, fi, _ = sps.find(f_c)
+        # face_cells has one row per fracture cell and one column per 3D face.
+        # Read the connections directly from the compressed rows; tocsr does
+        # not copy if the matrix is already stored as CSR
+        f_c = gb.edge_props((g3, g), 'face_cells').tocsr()
+        fi = f_c.indices
+        if fi.size == 0:
+            continue
+        num_hit = np.diff(f_c.indptr)
+        ci = np.repeat(np.arange(f_c.shape[0]), num_hit)
+        frac_edges.append((g, d, ci, fi, num_hit))
+    return frac_edges
+
+def cell_2_face(g3, data3, frac_edges, variable):
+    face_variable = np.zeros(g3.num_faces)
+    for g, d, ci, fi, _ in frac_edges:
         face_variable[fi] = d[variable][ci]
 
     data3['face_' + variable] = face_variable
 
-def face_2_cell(gb, variable):
-    g3 = gb.grids_of_dimension(3)[0]
-    data3 = gb.node_props(g3)
-    for g, d in gb:
-        if g.dim != 2:
-            continue
-        f_c = gb.edge_props((g3, g), 'face_cells')
-        ci, fi, _ = sps.find(f_c)
-
-        cell_variable = np.zeros(g.num_cells)
-        num_hit = np.zeros(g.num_cells)
-        for i, face in enumerate(fi):
-            cell_variable[ci[i]] += data3[variable][face]
-            num_hit[ci[i]] += 1
-        d[variable] = cell_variable / num_hit
+def _scatter_mean_numpy(face_values, ci, fi, num_hit, out):
+    # Average the face values over the faces hit by each fracture cell
+    cell_sum = np.bincount(ci, weights=face_values[fi], minlength=out.size)
+    out[:] = 0
+    np.divide(cell_sum, num_hit, out=out, where=num_hit > 0)
+
+def _scatter_mean_numba(face_values, ci, fi, num_hit, out):
+    # Same as above, but the gather and sum are done in one loop over the
+    # faces, without temporary arrays, followed by a loop over the cells
+    out[:] = 0
+    for k in range(ci.size):
+        out[ci[k]] += face_values[fi[k]]
+    for c in range(out.size):
+        if num_hit[c] > 0:
+            out[c] /= num_hit[c]
+
+if numba is not None:
+    _scatter_mean = numba.njit(cache=True)(_scatter_mean_numba)
+else:
+    _scatter_mean = _scatter_mean_numpy
+
+def face_2_cell(data3, frac_edges, variable):
+    # The cell values are written in place, so d[variable] must already be
+    # allocated on the 2D grids
+    for g, d, ci, fi, num_hit in frac_edges:
+        _scatter_mean(data3[variable], ci, fi, num_hit, d[variable])
 
 
 # ### Aperture update
@@ -263,12 +340,12 @@ def face_2_cell(gb, variable):
 # In[7]:
 
 
-def update_aperture(gb, name='aperture_change'):
-    for g, d in gb:
-        if g.dim != 2:
-            continue
-        E0 = d['flow_data'].E0
-        d['param'].set_aperture(E0 + d[name])
+def update_aperture(state):
+    # face_2_cell has written the aperture change of all fractures into one
+    # array, so the new aperture is computed in a single operation
+    aperture = state.E0 + state.aperture_change
+    for g, d in zip(state.grids, state.data):
+        d['param'].set_aperture(aperture[state.slices[g]])
 
 
 # # Set up solvers
@@ -306,13 +383,15 @@ dt = 10 * pp.MINUTE
 T = 18 * dt
 t = 0
 # Assign data to grid bucket
-assign_data(gb)
+fracture_state = assign_data(gb)
 
 # Define pressure solver for the given grid.
 # This will assign parameters, using the above classes
 flow_solver = pp.SlightlyCompressibleModel(gb, time_step=dt)
 mech_solver = pp.StaticModel(g3, data3)
 friction_solver = pp.FrictionSlipModel(g3, data3)
+# The fracture-matrix connections do not change in time
+frac_edges = fracture_face_cells(gb, g3)
 
 
 # ## Define Time loop
@@ -323,7 +402,7 @@ friction_solver = pp.FrictionSlipModel(g3, data3)
 # save initial condition
 flow_solver.pressure('pressure')
 friction_solver.aperture_change('aperture_change')
-face_2_cell(gb, 'aperture_change')
+face_2_cell(data3, frac_edges, 'aperture_change')
 exporter.write_vtk(['pressure', 'aperture_change'], 0)
 
 # Discretize linear elasticity
@@ -333,6 +412,10 @@ mech_solver.reassemble()
 time_steps = []
 time_steps.append(t)
 k = 0
+friction_solver.is_slipping = np.zeros(g3.num_faces, dtype=bool)
+# Buffer for the slip distance. It is stored in Fortran order, so that
+# ravel('F') gives a view rather than a copy
+slip_distance = np.zeros((g3.dim, g3.num_faces), order='F')
 
 while t < T:
     t += dt
@@ -345,21 +428,22 @@ while t < T:
     flow_solver.reassemble()         # Reasemble rhs
     flow_solver.step()               # solve for next time step
     flow_solver.pressure('pressure') # save solution to data
-    cell_2_face(gb, 'pressure')      # map cell pressure to 3D faces
+    cell_2_face(g3, data3, frac_edges, 'pressure')  # map cell pressure to 3D faces
 
     # solve mechanics
     do_slip = True
     # At the start of each time step we assume no fractures are slipping
-    friction_solver.is_slipping = np.zeros(g3.num_faces, dtype=np.bool)
+    friction_solver.is_slipping.fill(False)
     while np.any(do_slip):
         mech_solver.solve(discretize=False)
         mech_solver.traction('traction')
         do_slip = friction_solver.step()
-        data3['param'].set_slip_distance(friction_solver.x.ravel('F'))
+        slip_distance[:] = friction_solver.x
+        data3['param'].set_slip_distance(slip_distance.ravel('F'))
 
     friction_solver.aperture_change('aperture_change')  # Save aperture change to data
-    face_2_cell(gb, 'aperture_change')                  # Map aperture change to 2D cells
-    update_aperture(gb)                                 # Update the aperture
+    face_2_cell(data3, frac_edges, 'aperture_change')   # Map aperture change to 2D cells
+    update_aperture(fracture_state)                     # Update the aperture
     exporter.write_vtk(['pressure', 'aperture_change'], time_step=k)
 friction_solver
 exporter.write_pvd(np.array(time_steps))